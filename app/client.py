@@ -3,12 +3,34 @@ import json
 import logging
 import os
 import sys
-import time
+from collections import defaultdict
 from configparser import ConfigParser
-from typing import Any, Dict, List, Optional
+from io import StringIO
+from typing import Any, Dict, Optional
 
 import websockets
 
+try:
+    import orjson
+
+    def _json_loads(data: Any) -> Any:
+        return orjson.loads(data)
+
+    def _json_dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    # orjson 未導入環境では stdlib json にフォールバック
+    def _json_loads(data: Any) -> Any:
+        return json.loads(data)
+
+    def _json_dumps_bytes(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode()
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
 from .geminicli_runner import GeminiCLIRunner
 
 
@@ -16,6 +38,13 @@ logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(na
 
 logger = logging.getLogger("MenZ-GeminiCLI")
 
+# 受信メッセージで毎回参照するキー（intern 済み文字列はハッシュがキャッシュされる）
+_KEY_JSONRPC = sys.intern("jsonrpc")
+_KEY_PARAMS = sys.intern("params")
+_KEY_TYPE = sys.intern("type")
+_KEY_TEXT = sys.intern("text")
+_KEY_SPEAKER = sys.intern("speaker")
+
 
 def load_config(path: str) -> ConfigParser:
     config = ConfigParser()
@@ -50,9 +79,36 @@ async def handle_connection(
     ws = await websockets.connect(uri)
     try:
         logger.info("connected to %s", uri)
-        # 話者ごとのバッファとアイドルタスク
-        speaker_buffers: Dict[str, List[str]] = {}
-        buffer_lock = asyncio.Lock()
+        # 受信JSONの遅延パース用。Parser は内部バッファを再利用するため接続内で共有し、
+        # 必要なキー（params/type/text/speaker）だけを取り出す
+        json_parser = simdjson.Parser() if simdjson is not None else None
+        # 送信メッセージは text 以外すべて接続中は定数なので、JSON テンプレートを
+        # 一度だけシリアライズしておき、送信時はエスケープ済み text の差し込みだけにする。
+        # % フォーマットで差し込むため、speaker_name 等に含まれうる % を先に %% へ
+        # エスケープしてからプレースホルダを置く
+        out_template = _json_dumps_bytes(
+            {
+                "jsonrpc": "2.0",
+                "method": "notifications/subtitle",
+                "params": {
+                    "text": "__TEXT__",
+                    "speaker": speaker_name,
+                    "type": "comment",
+                    "language": "ja",
+                },
+            }
+        ).replace(b"%", b"%%").replace(b'"__TEXT__"', b"%s")
+
+        def encode_outgoing(comment: str) -> bytes:
+            # bytes のまま ws.send に渡す（websockets 側の utf-8 エンコードを省く）
+            return out_template % _json_dumps_bytes(comment)
+
+        # 話者ごとのバッファとアイドルタスク。
+        # asyncio はシングルスレッドで、追記・フラッシュとも await を挟まないため
+        # ロックは不要（協調スケジューリングのみで整合する）。
+        # StringIO に追記時点で改行込みで書き込み、フラッシュ時の join を省く
+        speaker_buffers: Dict[str, StringIO] = {}
+        speaker_lens: Dict[str, int] = defaultdict(int)
         idle_tasks: Dict[str, asyncio.Task] = {}
 
         def _speaker_key(s: Optional[str]) -> str:
@@ -73,12 +129,14 @@ async def handle_connection(
 
         async def flush_buffer(speaker: Optional[str]) -> None:
             key = _speaker_key(speaker)
-            async with buffer_lock:
-                buf = speaker_buffers.get(key, [])
-                if not buf:
-                    return
-                batched_text = "\n".join(buf)
-                speaker_buffers[key] = []
+            bufio = speaker_buffers.get(key)
+            if bufio is None or speaker_lens[key] == 0:
+                return
+            batched_text = bufio.getvalue().rstrip("\n")
+            # 推論を await する前に空にしておく（推論中に届く字幕は次バッチへ）
+            bufio.seek(0)
+            bufio.truncate(0)
+            speaker_lens[key] = 0
             try:
                 comment = await runner.generate_comment_async(subtitle_text=batched_text, speaker=speaker)
                 logger.info("comment: %s", comment)
@@ -88,18 +146,9 @@ async def handle_connection(
                 logger.exception("GeminiCLI error: %s", e)
                 comment = "いいね！"
 
-            outgoing = {
-                "jsonrpc": "2.0",
-                "method": "notifications/subtitle",
-                "params": {
-                    "text": comment,
-                    "speaker": speaker_name,
-                    "type": "comment",
-                    "language": "ja",
-                },
-            }
+            outgoing = encode_outgoing(comment)
             logger.debug("sending: %s", outgoing)
-            await ws.send(json.dumps(outgoing, ensure_ascii=False))
+            await ws.send(outgoing)
 
         async def idle_wait_and_flush(speaker: Optional[str]) -> None:
             try:
@@ -115,100 +164,127 @@ async def handle_connection(
             key = _speaker_key(speaker)
             idle_tasks[key] = asyncio.create_task(idle_wait_and_flush(speaker))
 
+        async def handle_comment(text: str, speaker: Optional[str]) -> None:
+            if not text:
+                logger.info("chat: (empty) (speaker=%s)", speaker)
+                return
+            logger.info("chat: %s (speaker=%s)", text, speaker)
+            # immediate processing for chat comments
+            try:
+                comment = await runner.generate_comment_async(subtitle_text=text, speaker=speaker)
+                logger.info("comment: %s", comment)
+            except asyncio.CancelledError:
+                # Don't catch CancelledError - let it propagate
+                raise
+            except Exception as e:
+                logger.exception("GeminiCLI error: %s", e)
+                comment = "いいね！"
+
+            outgoing = encode_outgoing(comment)
+            logger.debug("sending: %s", outgoing)
+            await ws.send(outgoing)
+
+        async def handle_subtitle(text: str, speaker: Optional[str]) -> None:
+            if not text:
+                logger.info("subtitle: (empty) (speaker=%s)", speaker)
+                return
+            logger.info("subtitle: %s (speaker=%s)", text, speaker)
+            key = _speaker_key(speaker)
+            # append からカウンタ更新まで await なし＝割り込まれない
+            bufio = speaker_buffers.get(key)
+            if bufio is None:
+                bufio = speaker_buffers[key] = StringIO()
+            bufio.write(text)
+            bufio.write("\n")
+            current_len = speaker_lens[key] = speaker_lens[key] + 1
+            if current_len >= max(1, lines_per_inference):
+                await flush_buffer(speaker)
+                cancel_idle_task(speaker)
+            else:
+                schedule_idle_flush(speaker)
+
+        # msg_type ごとのディスパッチテーブル（if/elif 連鎖の代わり）
+        message_handlers = {
+            "comment": handle_comment,
+            "subtitle": handle_subtitle,
+        }
+
         async def process_messages() -> None:
             """Process WebSocket messages."""
-            nonlocal speaker_buffers
-            
+            # recv と shutdown を asyncio.wait で競わせる。1秒ごとの wait_for
+            # ポーリングと違い、メッセージか shutdown が来るまで一切起床しない
+            shutdown_wait_task = (
+                asyncio.create_task(shutdown_event.wait()) if shutdown_event else None
+            )
+            recv_task = None
             try:
                 while True:
-                    # Check for shutdown
-                    if shutdown_event and shutdown_event.is_set():
-                        logger.info("shutdown requested, exiting message loop")
-                        break
-                    
-                    # Receive with timeout to allow cancellation
+                    recv_task = asyncio.create_task(ws.recv())
+                    if shutdown_wait_task is not None:
+                        await asyncio.wait(
+                            {recv_task, shutdown_wait_task},
+                            return_when=asyncio.FIRST_COMPLETED,
+                        )
+                        if shutdown_wait_task.done():
+                            logger.info("shutdown requested, exiting message loop")
+                            break
                     try:
-                        message = await asyncio.wait_for(ws.recv(), timeout=1.0)
-                    except asyncio.TimeoutError:
-                        # No message, loop again (allows cancellation check)
-                        continue
+                        message = await recv_task
                     except websockets.exceptions.ConnectionClosed:
                         logger.info("websocket connection closed")
                         break
-                    
+
                     logger.debug("received raw: %s", message)
                     try:
-                        payload: Dict[str, Any] = json.loads(message)
+                        if json_parser is not None:
+                            try:
+                                payload: Any = json_parser.parse(
+                                    message if isinstance(message, bytes) else message.encode()
+                                )
+                            except Exception:
+                                # simdjson が扱えないフレームは orjson/stdlib で再試行する
+                                payload = _json_loads(message)
+                        else:
+                            payload = _json_loads(message)
                     except Exception:
                         logger.warning("received non-JSON message: %s", message)
                         continue
 
                     # MCP フォーマット対応: params から値を取得
-                    if payload.get("jsonrpc") == "2.0" and "params" in payload:
-                        params = payload.get("params", {})
-                        msg_type = params.get("type")
-                        text = params.get("text", "")
-                        speaker = params.get("speaker")
+                    # （simdjson の場合は proxy なので as_dict() せず必要なキーだけ参照する）
+                    params = payload.get(_KEY_PARAMS)
+                    if payload.get(_KEY_JSONRPC) == "2.0" and params is not None:
+                        msg_type = params.get(_KEY_TYPE)
+                        text = params.get(_KEY_TEXT, "")
+                        speaker = params.get(_KEY_SPEAKER)
                     else:
                         # レガシー形式対応
-                        msg_type = payload.get("type")
-                        text = payload.get("text", "")
-                        speaker = payload.get("speaker")
-
-                    if msg_type == "comment":
-                        if not text:
-                            logger.info("chat: (empty) (speaker=%s)", speaker)
-                            continue
-                        logger.info("chat: %s (speaker=%s)", text, speaker)
-                        # immediate processing for chat comments
-                        try:
-                            comment = await runner.generate_comment_async(subtitle_text=text, speaker=speaker)
-                            logger.info("comment: %s", comment)
-                        except asyncio.CancelledError:
-                            # Don't catch CancelledError - let it propagate
-                            raise
-                        except Exception as e:
-                            logger.exception("GeminiCLI error: %s", e)
-                            comment = "いいね！"
-
-                        outgoing = {
-                            "jsonrpc": "2.0",
-                            "method": "notifications/subtitle",
-                            "params": {
-                                "text": comment,
-                                "speaker": speaker_name,
-                                "type": "comment",
-                                "language": "ja",
-                            },
-                        }
-                        logger.debug("sending: %s", outgoing)
-                        await ws.send(json.dumps(outgoing, ensure_ascii=False))
-                        continue
-                    if msg_type != "subtitle":
-                        logger.debug("skip message type=%s", msg_type)
-                        continue
+                        msg_type = payload.get(_KEY_TYPE)
+                        text = payload.get(_KEY_TEXT, "")
+                        speaker = payload.get(_KEY_SPEAKER)
 
-                    if not text:
-                        logger.info("subtitle: (empty) (speaker=%s)", speaker)
-                        continue
+                    # 取り出した値は str に実体化済み。simdjson の proxy を持ったまま
+                    # 次の parse() を呼ぶとパーサ再利用エラーになるため、ここで手放す
+                    payload = params = None
 
-                    logger.info("subtitle: %s (speaker=%s)", text, speaker)
-                    key = _speaker_key(speaker)
-                    async with buffer_lock:
-                        buf = speaker_buffers.setdefault(key, [])
-                        buf.append(text)
-
-                    async with buffer_lock:
-                        current_len = len(speaker_buffers.get(key, []))
-                    if current_len >= max(1, lines_per_inference):
-                        await flush_buffer(speaker)
-                        cancel_idle_task(speaker)
-                    else:
-                        schedule_idle_flush(speaker)
+                    handler = message_handlers.get(msg_type)
+                    if handler is None:
+                        logger.debug("skip message type=%s", msg_type)
+                        continue
+                    await handler(text, speaker)
             except asyncio.CancelledError:
                 logger.info("message processing cancelled")
                 raise
-        
+            finally:
+                # 競わせたタスクの残りを確実に回収する
+                for task in (recv_task, shutdown_wait_task):
+                    if task is not None and not task.done():
+                        task.cancel()
+                        try:
+                            await task
+                        except (asyncio.CancelledError, Exception):
+                            pass
+
         # Create message processing task
         msg_task = asyncio.create_task(process_messages())
         
@@ -280,9 +356,8 @@ async def main_with_runner(config: ConfigParser, runner: GeminiCLIRunner) -> Non
         if not shutdown_event.is_set():
             shutdown_event.set()
             # Force immediate exit if not shutting down within 2 seconds
+            # （スレッドを立てず、イベントループのタイマーで予約する）
             def force_exit():
-                logger.debug("force exit timer started (2 seconds)")
-                time.sleep(2)
                 logger.warning("forced shutdown - killing process")
                 if runner:
                     try:
@@ -290,13 +365,15 @@ async def main_with_runner(config: ConfigParser, runner: GeminiCLIRunner) -> Non
                     except Exception as e:
                         logger.error("error during forced close: %s", e)
                 os._exit(1)
-            import threading
-            threading.Thread(target=force_exit, daemon=True).start()
+            loop.call_later(2.0, force_exit)
     
     import signal as signal_module
     loop.add_signal_handler(signal_module.SIGINT, signal_handler)
     loop.add_signal_handler(signal_module.SIGTERM, signal_handler)
     
+    # Shutdown wait task は再接続ループ全体で1つだけ作って使い回す
+    # （イテレーションごとの生成と pending 放置によるタスクリークを防ぐ）
+    shutdown_task = asyncio.create_task(shutdown_event.wait())
     try:
         backoff_ms = max(0, reconnect_initial_ms)
         while not shutdown_event.is_set():
@@ -310,10 +387,7 @@ async def main_with_runner(config: ConfigParser, runner: GeminiCLIRunner) -> Non
                     speaker_name=speaker_name,
                     shutdown_event=shutdown_event,
                 ))
-                
-                # Create shutdown wait task
-                shutdown_task = asyncio.create_task(shutdown_event.wait())
-                
+
                 # Wait for either to complete
                 done, pending = await asyncio.wait(
                     {connection_task, shutdown_task},
@@ -344,6 +418,12 @@ async def main_with_runner(config: ConfigParser, runner: GeminiCLIRunner) -> Non
                 await asyncio.sleep(sleep_ms / 1000.0)
                 backoff_ms = min(backoff_ms * 2, reconnect_max_ms)
     finally:
+        if not shutdown_task.done():
+            shutdown_task.cancel()
+            try:
+                await shutdown_task
+            except asyncio.CancelledError:
+                pass
         # Remove signal handlers
         loop.remove_signal_handler(signal_module.SIGINT)
         loop.remove_signal_handler(signal_module.SIGTERM)
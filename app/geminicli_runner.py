@@ -1,11 +1,48 @@
+import concurrent.futures
+import functools
 import re
 import logging
 import asyncio
+import string
+import threading
 import time
 from typing import Optional
 import pexpect
 
 
+def _strip_ansi(s: str) -> str:
+    """ANSIエスケープシーケンスを除去する。
+
+    エスケープを含まない行（ストリーミング中の大半）は find 1回（C実装の
+    memchr 相当）で即 return し、正規表現エンジンを起動しない。含む行のみ
+    小さな状態機械でシーケンスを読み飛ばす。
+    """
+    i = s.find('\x1b')
+    if i < 0:
+        return s
+    out = []
+    start = 0
+    n = len(s)
+    while i >= 0:
+        out.append(s[start:i])
+        j = i + 1
+        if j < n and s[j] == '[':
+            # CSI: ESC [ パラメータ[0-?]* 中間[ -/]* 終端[@-~]
+            j += 1
+            while j < n and '0' <= s[j] <= '?':
+                j += 1
+            while j < n and ' ' <= s[j] <= '/':
+                j += 1
+            if j < n:
+                j += 1  # 終端バイト
+        elif j < n and ('@' <= s[j] <= 'Z' or '\\' <= s[j] <= '_'):
+            j += 1  # 2文字エスケープ
+        start = j
+        i = s.find('\x1b', start)
+    out.append(s[start:])
+    return ''.join(out)
+
+
 class GeminiCLIRunner:
     """
     Wrapper around Gemini CLI in interactive mode using pexpect.
@@ -30,10 +67,34 @@ class GeminiCLIRunner:
         '\\': '＼', # エスケープ文字
         '~': '～'   # ホームディレクトリ
     }
-    
+
+    # str.translate 用の変換テーブル（C実装の1パスで全置換できる）
+    _TRANS_TABLE = str.maketrans(_SPECIAL_CHAR_MAP)
+
+    # これ以上長いテキストはメモ化しない（長文はほぼ毎回ユニークでキャッシュが無駄）
+    _SANITIZE_CACHE_MAX_LEN = 256
+
     # スピナー文字（ローディング中の判定用）
     _SPINNER_CHARS = '⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏'
 
+    # 行頭の箇条書き記号・連番・ロールプレフィックスを1パスで検出する
+    # （startswith のタプル判定＋プレフィックスのループを置き換える）
+    _PREFIX_RE = re.compile(
+        r'^(?:・\s*|[-*»✔✓]\s+|\d+\.\s+)?(?:(?:assistant|model|output):\s*)?',
+        re.IGNORECASE,
+    )
+
+    # 行分類用の単一正規表現。✦（本文つき）/ スピナー行 / Using: 行 を
+    # 1パスで判定し、lastgroup で分岐する
+    _LINE_RE = re.compile(
+        r'✦\s*(?P<body>.*)'
+        r'|^(?P<spinner>[⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏])'
+        r'|^(?P<using>Using:)'
+    )
+
+    # prompt テンプレートで使用できるプレースホルダ
+    _TEMPLATE_FIELDS = frozenset({"text", "speaker", "speaker_part", "lines_num"})
+
     def __init__(
         self,
         model_name: str,
@@ -48,11 +109,46 @@ class GeminiCLIRunner:
         self._logger = logging.getLogger("MenZ-GeminiCLI")
         self.prompt_template = prompt_template
         self.system_prompt = system_prompt
-        
+
+        # テンプレートは初期化時に一度だけパースしておき、推論ごとの
+        # str.format による書式文字列の再解析を省く。使われている
+        # プレースホルダも控えておき、不要な speaker_part / lines_num の
+        # 計算をスキップする
+        if prompt_template:
+            parts = list(string.Formatter().parse(prompt_template))
+            self._template_fields = {field for _, field, _, _ in parts if field}
+            # 設定ミス（{speakr} 等）は空文字で握りつぶさず起動時に落とす
+            unknown = self._template_fields - self._TEMPLATE_FIELDS
+            if unknown:
+                raise ValueError(
+                    "prompt template has unknown placeholders: "
+                    + ", ".join(sorted(unknown))
+                )
+            # 書式指定（{lines_num:02d}）や変換（{text!r}）付きは単純連結では
+            # 再現できないため、str.format へのフォールバックに回す
+            if any(spec or conv for _, field, spec, conv in parts if field is not None):
+                self._template_parts = None
+            else:
+                self._template_parts = parts
+        else:
+            self._template_parts = None
+            self._template_fields = frozenset()
+        # システムプロンプトは定数なのでサニタイズも一度だけ
+        self._sanitized_system_prompt = (
+            self._sanitize_text(system_prompt) if system_prompt else None
+        )
+
         self._child = None
         self._initialized = False
-        self._ansi_re = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
         self._last_answer: Optional[str] = None  # 前回の回答を保持
+        # 専用リーダースレッドが行を積むキュー（行単位の to_thread 起動を排除）
+        self._line_queue: Optional[asyncio.Queue] = None
+        self._reader_thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 子プロセスへの書き込み専用の1ワーカー executor。
+        # デフォルトの ThreadPoolExecutor（最大32スレッド・随時生成）を使わず、
+        # 順序保証とスレッド生成コスト回避のため専用化する
+        self._send_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
     async def _initialize_async(self) -> None:
         """Initialize pexpect session with Gemini CLI."""
@@ -87,7 +183,19 @@ class GeminiCLIRunner:
                 self._logger.warning("timeout waiting for initial prompt")
         except Exception as e:
             self._logger.error("failed to wait for initial prompt: %s", e)
-        
+
+        self._send_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='pexpect'
+        )
+
+        # 以降の読み取りはすべて専用スレッド経由（行ごとの executor 起動コストを回避）
+        self._loop = asyncio.get_running_loop()
+        self._line_queue = asyncio.Queue()
+        self._reader_thread = threading.Thread(
+            target=self._reader_loop, name="gemini-reader", daemon=True
+        )
+        self._reader_thread.start()
+
         # Send system prompt if configured
         if self.system_prompt:
             await self._send_system_prompt_async()
@@ -95,21 +203,54 @@ class GeminiCLIRunner:
         self._initialized = True
         self._logger.info("pexpect session initialized successfully")
 
+    def _reader_loop(self) -> None:
+        """pexpect の readline を専用スレッドで回し、行をキューに積む。
+
+        行単位に asyncio.to_thread を起動するより executor/コンテキスト切替の
+        オーバーヘッドが小さい。EOF やエラー時は None センチネルを積んで終了する。
+        """
+        child = self._child
+        loop = self._loop
+        queue = self._line_queue
+        try:
+            while child is self._child:
+                try:
+                    line = child.readline()
+                except pexpect.TIMEOUT:
+                    continue
+                if line == '':
+                    break  # EOF
+                loop.call_soon_threadsafe(queue.put_nowait, line)
+        except Exception:
+            pass
+        finally:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+            except Exception:
+                pass
+
+    async def _read_line(self, deadline: float) -> Optional[str]:
+        """リーダースレッドが積んだ行を deadline まで待って取り出す（None=EOF/タイムアウト）"""
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self._line_queue.get(), timeout=remaining)
+        except asyncio.TimeoutError:
+            return None
+
     async def _wait_prompt(self) -> bool:
         """プロンプトが表示されるまで待つ"""
+        deadline = time.time() + 10
         try:
-            idx = await asyncio.to_thread(
-                self._child.expect,
-                [
-                    r'>\s+Type your message or @path/to/file',
-                    r'>\s+Type your message',
-                    r'>',
-                    pexpect.TIMEOUT,
-                    pexpect.EOF
-                ],
-                timeout=10
-            )
-            return idx in (0, 1, 2)
+            while True:
+                line = await self._read_line(deadline)
+                if line is None:
+                    self._logger.warning("timed out waiting for prompt")
+                    return False
+                clean = _strip_ansi(line)
+                if '>' in clean:
+                    return True
         except Exception as e:
             self._logger.warning("failed to wait for prompt: %s", e)
             return False
@@ -137,45 +278,48 @@ class GeminiCLIRunner:
             is_loading = False
             
             while time.time() < deadline:
-                try:
-                    line2 = await asyncio.to_thread(self._child.readline)
-                    line2 = line2.rstrip('\r\n')
-                except Exception:
+                line2 = await self._read_line(deadline)
+                if line2 is None:
                     break
-                
-                clean2 = self._ansi_re.sub('', line2)
+                line2 = line2.rstrip('\r\n')
+
+                clean2 = _strip_ansi(line2)
                 cont2 = clean2.strip()
-                
+
+                # 行の種別を1パスで判定
+                m2 = self._LINE_RE.search(cont2)
+                kind = m2.lastgroup if m2 else None
+
                 # ✦で新しい回答が始まった場合は更新（ストリーミングで何度も来る）
-                m2 = re.search(r'✦\s*(.*)', cont2)
-                if m2:
-                    body2 = m2.group(1).strip()
+                if kind == 'body':
+                    body2 = m2.group('body').strip()
                     if body2:
                         last = body2
                         found_empty_after_diamond = False
                     continue
-                
+
                 # ローディングメッセージ（スピナー）が来たら、まだ生成中
-                if any(cont2.startswith(c) for c in self._SPINNER_CHARS):
+                if kind == 'spinner':
                     is_loading = True
                     found_empty_after_diamond = False
                     continue
-                
+
                 # ANSI削除後に空になる行（実質的な空行）
                 if cont2 == '' and last is not None:
                     # ローディング中でなければ空行としてカウント
                     if not is_loading:
                         found_empty_after_diamond = True
                     continue
-                
+
                 # 空行の後にUsing:が来たら確定
-                if found_empty_after_diamond and cont2.startswith('Using:'):
+                if found_empty_after_diamond and kind == 'using':
                     phase2_elapsed = time.time() - phase2_start
                     self._logger.debug("Phase2: confirmed after %.2fs: %r", phase2_elapsed, last)
                     return last
-                
-                # スピナー以外の実質的な内容が来たらローディング終了
-                if cont2 != '' and not any(cont2.startswith(c) for c in self._SPINNER_CHARS):
+
+                # ここに到達するのはスピナーでも✦でもない行と分類済みなので、
+                # 再判定せず、内容があればローディング終了とみなす
+                if cont2:
                     is_loading = False
             
             phase2_elapsed = time.time() - phase2_start
@@ -186,19 +330,18 @@ class GeminiCLIRunner:
         self._logger.debug("Phase1: starting")
         phase1_start = time.time()
         while time.time() < deadline:
-            try:
-                line = await asyncio.to_thread(self._child.readline)
-                line = line.rstrip('\r\n')
-            except Exception:
+            line = await self._read_line(deadline)
+            if line is None:
                 break
-            
-            clean = self._ansi_re.sub('', line)
+            line = line.rstrip('\r\n')
+
+            clean = _strip_ansi(line)
             content = clean.strip()
-            
+
             # ✦ が行頭でなくても同一行に連結されるケースを拾う
-            m = re.search(r'✦\s*(.*)', content)
-            if m:
-                body = m.group(1).strip()
+            m = self._LINE_RE.search(content)
+            if m and m.lastgroup == 'body':
+                body = m.group('body').strip()
                 phase1_elapsed = time.time() - phase1_start
                 self._logger.debug("Phase1: found ✦ after %.2fs: %r", phase1_elapsed, body)
                 
@@ -223,8 +366,8 @@ class GeminiCLIRunner:
         """Send initial system prompt and wait for response."""
         self._logger.info("sending system prompt")
         try:
-            # サニタイズしてから送信
-            sanitized_prompt = self._sanitize_text(self.system_prompt)
+            # 初期化時にサニタイズ済みのものを送信
+            sanitized_prompt = self._sanitized_system_prompt
             self._child.send(sanitized_prompt)
             await asyncio.sleep(0.1)
             self._child.send('\r')
@@ -252,13 +395,17 @@ class GeminiCLIRunner:
         """
         if not text:
             return text
-        
-        # 各特殊文字を全角に置き換え
-        sanitized = text
-        for half_char, full_char in self._SPECIAL_CHAR_MAP.items():
-            sanitized = sanitized.replace(half_char, full_char)
-        
-        return sanitized
+        if len(text) > self._SANITIZE_CACHE_MAX_LEN:
+            # 事前構築したテーブルで1パス置換（replace の14回ループより高速）
+            return text.translate(self._TRANS_TABLE)
+        # speaker 名など少数の短い値が繰り返し来るためメモ化が効く
+        return self._translate_cached(text)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _translate_cached(text: str) -> str:
+        """短い入力向けの変換結果キャッシュ（同一 speaker 等の再変換を O(1) に）"""
+        return text.translate(GeminiCLIRunner._TRANS_TABLE)
 
     def build_prompt(self, subtitle_text: str, speaker: Optional[str]) -> str:
         """Build prompt for subtitle text."""
@@ -267,14 +414,29 @@ class GeminiCLIRunner:
         sanitized_speaker = self._sanitize_text(speaker) if speaker else None
         
         if self.prompt_template:
-            speaker_part = f"（話者: {sanitized_speaker}）" if sanitized_speaker else ""
-            lines_num = sanitized_text.count("\n") + 1 if sanitized_text else 0
-            return self.prompt_template.format(
-                text=sanitized_text,
-                speaker=sanitized_speaker or "",
-                speaker_part=speaker_part,
-                lines_num=lines_num,
-            )
+            values = {
+                "text": sanitized_text,
+                "speaker": sanitized_speaker or "",
+            }
+            # テンプレートで参照されている場合のみ計算する
+            if "speaker_part" in self._template_fields:
+                values["speaker_part"] = (
+                    f"（話者: {sanitized_speaker}）" if sanitized_speaker else ""
+                )
+            if "lines_num" in self._template_fields:
+                values["lines_num"] = sanitized_text.count("\n") + 1 if sanitized_text else 0
+            if self._template_parts is not None:
+                # パース済みパーツの連結（str.format の再パースなし）。
+                # プレースホルダは __init__ で検証済みなので values に必ずある
+                pieces = []
+                for literal, field, _spec, _conv in self._template_parts:
+                    if literal:
+                        pieces.append(literal)
+                    if field is not None:
+                        pieces.append(str(values[field]))
+                return "".join(pieces)
+            # 書式指定・変換付きテンプレートは str.format で組み立てる
+            return self.prompt_template.format(**values)
         else:
             return f"{sanitized_speaker}「{sanitized_text}」" if sanitized_speaker else f"「{sanitized_text}」"
 
@@ -291,11 +453,12 @@ class GeminiCLIRunner:
             if sanitized_prompt != prompt:
                 self._logger.debug("sanitized prompt: special chars converted to full-width")
             
-            # プロンプトを送信
-            await asyncio.to_thread(self._child.send, sanitized_prompt)
+            # プロンプトを送信（専用1ワーカー executor 経由で順序を保証）
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._send_executor, self._child.send, sanitized_prompt)
             await asyncio.sleep(0.1)
             start_time = time.monotonic()
-            await asyncio.to_thread(self._child.send, '\r')
+            await loop.run_in_executor(self._send_executor, self._child.send, '\r')
             
             # 改善された待機ロジックを使用（前回の回答をスキップ）
             answer = await self._wait_answer(
@@ -324,29 +487,36 @@ class GeminiCLIRunner:
             raise
 
     def _extract_comment(self, raw_output: str) -> str:
-        # Remove ANSI escape sequences
-        cleaned_output = self._ansi_re.sub("", raw_output)
-
-        # Take the first non-empty line, strip common markdown fences and quotes
-        for line in cleaned_output.splitlines():
-            normalized = line.strip()
+        # Take the first non-empty line, strip common markdown fences and quotes.
+        # 返すのは先頭の非空行だけなので、全体をANSI除去してから分割するのではなく
+        # 行単位に除去しながら走査し、見つかった時点で打ち切る
+        for line in raw_output.splitlines():
+            normalized = _strip_ansi(line).strip()
             if not normalized:
                 continue
+            # 先に上限＋マージンまで切り詰めて、以降の整形処理の仕事量を
+            # モデル出力長ではなく max_output_chars で抑える
+            # （マージンはプレフィックス・引用符の除去で縮む分の余裕）
+            truncated = False
+            if self.max_output_chars > 0 and len(normalized) > self.max_output_chars + 16:
+                normalized = normalized[: self.max_output_chars + 16]
+                truncated = True
             # Remove code fences or markdown bullets if present
-            if normalized.startswith("```") and normalized.endswith("```"):
+            # （切り詰めた行は終端側のフェンスが失われているため先頭側だけで判定する）
+            if normalized.startswith("```") and (truncated or normalized.endswith("```")):
                 normalized = normalized.strip("`")
-            # Trim leading markdown bullets/numbers
-            if normalized.startswith(('- ', '* ', '1. ', '・', '✔ ', '✓ ', '» ')):
-                normalized = normalized[2:].strip()
-            # Remove common role prefixes
-            for prefix in ("assistant:", "model:", "output:"):
-                if normalized.lower().startswith(prefix):
-                    normalized = normalized[len(prefix):].strip()
+            # Trim leading markdown bullets/numbers and role prefixes in one pass
+            m = self._PREFIX_RE.match(normalized)
+            if m and m.end():
+                normalized = normalized[m.end():].strip()
             # Remove wrapping quotes
-            if (normalized.startswith('"') and normalized.endswith('"')) or (
-                normalized.startswith("'") and normalized.endswith("'")
-            ):
-                normalized = normalized[1:-1].strip()
+            # （同様に、切り詰めた行は閉じ引用符が無くても先頭側だけ剥がす）
+            first = normalized[:1]
+            if first in ('"', "'"):
+                if len(normalized) > 1 and normalized.endswith(first):
+                    normalized = normalized[1:-1].strip()
+                elif truncated:
+                    normalized = normalized[1:].strip()
 
             # Enforce max length
             if self.max_output_chars > 0 and len(normalized) > self.max_output_chars:
@@ -354,7 +524,7 @@ class GeminiCLIRunner:
             return normalized
 
         # If no lines were extractable, fallback to whole cleaned output (truncated)
-        fallback = cleaned_output.strip()
+        fallback = _strip_ansi(raw_output).strip()
         return fallback[: self.max_output_chars] if fallback else ""
 
     async def generate_comment_async(self, subtitle_text: str, speaker: Optional[str]) -> str:
@@ -384,22 +554,33 @@ class GeminiCLIRunner:
         if self._child:
             try:
                 self._child.sendline("/quit")
-                self._child.expect(pexpect.EOF, timeout=2)
             except:
                 pass
-            
+
+            # expect(EOF) はリーダースレッドの readline と競合するため行わない。
+            # close でリーダー側が EOF/例外を受けて自然に終了する
             try:
                 self._child.close(force=True)
             except:
                 pass
-            
+
             self._child = None
-        
+
+        if self._reader_thread is not None:
+            self._reader_thread.join(timeout=2)
+            self._reader_thread = None
+        self._line_queue = None
+
+        if self._send_executor is not None:
+            self._send_executor.shutdown(wait=False)
+            self._send_executor = None
+
         self._initialized = False
         self._last_answer = None
         self._logger.debug("pexpect session closed")
 
     def __del__(self) -> None:
         """Cleanup on destruction."""
-        if self._initialized:
+        # __init__ がテンプレート検証で例外を出した場合は属性が無い
+        if getattr(self, "_initialized", False):
             self.close()
\ No newline at end of file
@@ -1,199 +1,304 @@
 #!/usr/bin/env python3
 import pexpect
+import os
 import sys
 import time
 import re
 
-def main():
-    print("Starting gemini with pexpect (simple 2-turn test)...")
-    
-    # タイムアウト定数
-    DEFAULT_TIMEOUT = 20
-    
-    # 特殊文字から全角文字への変換マッピング
-    SPECIAL_CHAR_MAP = {
-        '/': '／',  # スラッシュコマンド
-        '!': '！',  # シェルコマンド実行
-        '.': '．',  # ファイル操作
-        '@': '＠',  # ファイル参照
-        '#': '＃',  # コメント
-        '$': '＄',  # 変数展開
-        '(': '（',  # グループ化
-        ')': '）',  # グループ化
-        '`': '｀',  # コマンド置換
-        '|': '｜',  # パイプ
-        '&': '＆',  # バックグラウンド実行
-        ';': '；',  # コマンド区切り
-        '\\': '＼', # エスケープ文字
-        '~': '～'   # ホームディレクトリ
-    }
-    
-    def sanitize_text(text: str) -> str:
-        """特殊な予約文字を全角文字に置き換える"""
-        if not text:
-            return text
-        sanitized = text
-        for half_char, full_char in SPECIAL_CHAR_MAP.items():
-            sanitized = sanitized.replace(half_char, full_char)
-        return sanitized
+# [DEBUG ...] 出力の有効化フラグ（ホットループ内の f-string 整形と
+# stdout 書き込みを、必要なときだけに抑える）
+DEBUG = bool(os.environ.get('MENZ_DEBUG'))
 
-    child = pexpect.spawn('gemini', ['-m', 'gemini-2.5-flash'], encoding='utf-8', timeout=60)
-    child.setwinsize(24, 160)
+# タイムアウト定数
+DEFAULT_TIMEOUT = 20
+
+# ホットループで使う正規表現はモジュールスコープで一度だけコンパイルする
+# （文字列パターンの re.search は呼び出しごとに内部キャッシュを引き直す）
+# re.ASCII でUnicode向けのフォールバック経路を避ける（対象はASCII制御列のみ）
+ANSI_RE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])', re.ASCII)
+PROMPT_PATTERNS = [
+    re.compile(r'>\s+Type your message or @path/to/file'),
+    re.compile(r'>\s+Type your message'),
+    re.compile(r'>'),
+]
+
+# 特殊文字から全角文字への変換マッピング
+SPECIAL_CHAR_MAP = {
+    '/': '／',  # スラッシュコマンド
+    '!': '！',  # シェルコマンド実行
+    '.': '．',  # ファイル操作
+    '@': '＠',  # ファイル参照
+    '#': '＃',  # コメント
+    '$': '＄',  # 変数展開
+    '(': '（',  # グループ化
+    ')': '）',  # グループ化
+    '`': '｀',  # コマンド置換
+    '|': '｜',  # パイプ
+    '&': '＆',  # バックグラウンド実行
+    ';': '；',  # コマンド区切り
+    '\\': '＼', # エスケープ文字
+    '~': '～'   # ホームディレクトリ
+}
+
+# str.translate 用の変換テーブル（C実装の1パスで全置換できる）
+_SANITIZE_TRANS = str.maketrans(SPECIAL_CHAR_MAP)
+
+# 置換が1文字→1文字である限り translate が最速。将来 '```' のような
+# 複数文字キーが必要になったら False に切り替える（translate は
+# 1文字キーしか扱えないため、その場合はこの正規表現経路を使う）
+USE_TRANSLATE = True
+_SANITIZE_RE = re.compile('|'.join(map(re.escape, SPECIAL_CHAR_MAP)))
+
+# スピナー文字（ローディング中の判定用）。先頭1文字の set 参照1回で判定する
+SPINNERS = frozenset('⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏')
+
+
+# ホットループで呼ぶ関数はモジュールスコープに置く（呼び出しごとの
+# クロージャ再構築をなくし、デフォルト引数でグローバル参照を LOAD_FAST 化する）
+
+def sanitize_text(text: str) -> str:
+    """特殊な予約文字を全角文字に置き換える"""
+    if not text:
+        return text
+    # 事前構築したテーブルで1パス置換（replace の14回ループより高速）
+    if USE_TRANSLATE:
+        return text.translate(_SANITIZE_TRANS)
+    return _SANITIZE_RE.sub(lambda m: SPECIAL_CHAR_MAP[m.group()], text)
+
+
+def parse_diamond(s: str) -> str | None:
+    """✦ 以降の本文を返す。✦ が無ければ None。
+
+    旧 DIAMOND_RE（✦\\s*(.*)）の置き換え。行末まで取るだけなので
+    正規表現は不要で、find + スライス + strip の方が速い
+    """
+    i = s.find('✦')
+    if i < 0:
+        return None
+    return s[i + 1:].strip()
+
+
+def strip_ansi(s: str, _sub=ANSI_RE.sub) -> str:
+    # ESCを含まない行（ストリーミング中の大半）は1回の in 判定（C実装の
+    # memchr相当）だけで返し、正規表現エンジンを起動しない
+    if '\x1b' not in s:
+        return s
+    return _sub('', s)
+
+
+class Tee:
     # Mirror all CUI output to stdout and also save to file
-    class Tee:
-        def __init__(self, *files):
-            self.files = files
-        def write(self, data):
-            for f in self.files:
-                try:
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        # pexpect はチャンク（サブ行）単位で write してくるため、
+        # 都度 flush すると1文字ごとに syscall が走る。バッファに任せて
+        # flush は finally でまとめて行う
+        for f in self.files:
+            try:
+                if f is sys.stdout:
+                    # TextIOWrapper のエンコード・改行変換層を飛ばして
+                    # バイナリバッファへ直接書く（端末に出せない文字は置換）
+                    f.buffer.write(data.encode('utf-8', 'replace'))
+                else:
                     f.write(data)
-                    f.flush()
-                except Exception:
-                    pass
-        def flush(self):
-            for f in self.files:
-                try:
-                    f.flush()
-                except Exception:
-                    pass
-
-    log_file = open('/tmp/gemini_pexpect.log', 'w')
-    child.logfile = Tee(sys.stdout, log_file)
-
-    ansi_re = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-
-    def wait_prompt() -> bool:
-        idx = child.expect([
-            r'>\s+Type your message or @path/to/file',
-            r'>\s+Type your message',
-            r'>',
-            pexpect.TIMEOUT,
-            pexpect.EOF
-        ], timeout=10)
-        return idx in (0, 1, 2)
-
-    def wait_answer(timeout_s: int = 20, skip_text: str | None = None, quiet_s: float = 1.0) -> str | None:
-        deadline = time.time() + timeout_s
-        print(f"[DEBUG wait_answer] Starting, timeout={timeout_s}s, skip_text={skip_text!r}")
+            except Exception:
+                pass
 
-        def read_until_confirmed_return_last(initial_text: str | None = None) -> str | None:
-            # ✦ → (ローディング終了) → 空行 → Using: のパターンで確定
-            # スピナーがある間は未確定、消えたら確定
-            print(f"[DEBUG Phase2] Starting Phase 2 with initial_text={initial_text!r}")
-            phase2_start = time.time()
-            last: str | None = initial_text  # Phase 1で見つけた✦を初期値とする
+    def flush(self):
+        for f in self.files:
+            try:
+                f.flush()
+            except Exception:
+                pass
+
+
+def iter_lines(child, deadline: float, _monotonic=time.monotonic):
+    # 行単位の expect はチャンク毎に正規表現マッチを回すため、
+    # 4KB単位の read_nonblocking + str.split で自前分割する方が安い。
+    # 残り時間は deadline から毎回導出し、TIMEOUT / EOF で打ち切る。
+    # 確定後に残った未分割バッファは捨てられるが、TUIがプロンプトを
+    # 繰り返し再描画するため後段の wait_prompt は問題なくマッチする
+    buf = ''
+    # メソッド参照の束縛をループ外で1回だけ行う
+    _read = child.read_nonblocking
+    while True:
+        remaining = deadline - _monotonic()
+        if remaining <= 0:
+            return
+        try:
+            chunk = _read(size=4096, timeout=remaining)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            return
+        buf += chunk
+        if '\n' not in buf:
+            continue
+        *lines, buf = buf.split('\n')
+        for line in lines:
+            yield line
+
+
+def wait_prompt(child) -> bool:
+    # expect_list はコンパイル済みパターンをそのまま使う（再コンパイルなし）
+    idx = child.expect_list(PROMPT_PATTERNS + [pexpect.TIMEOUT, pexpect.EOF], timeout=10)
+    return idx in (0, 1, 2)
+
+
+def read_until_confirmed_return_last(
+    lines,
+    initial_text: str | None = None,
+    _monotonic=time.monotonic,
+    _parse=parse_diamond,
+    _strip=strip_ansi,
+    _spinners=SPINNERS,
+) -> str | None:
+    # ✦ → (ローディング終了) → 空行 → Using: のパターンで確定
+    # スピナーがある間は未確定、消えたら確定
+    # lines は Phase 1 と共有する iter_lines ジェネレータ（バッファも共有される）
+    if DEBUG:
+        print(f"[DEBUG Phase2] Starting Phase 2 with initial_text={initial_text!r}")
+    phase2_start = _monotonic()
+    last: str | None = initial_text  # Phase 1で見つけた✦を初期値とする
+    found_empty_after_diamond = False
+    is_loading = False
+
+    for line2 in lines:
+        # rstrip('\r\n') はしない（後段の strip() が改行類も除去する）
+        clean2 = _strip(line2)
+        cont2 = clean2.strip()
+
+        # 1行につき1分岐だけ実行する（頻度順: 空行 → スピナー → ✦ → Using: → その他）
+        if not cont2:
+            # ANSI削除後に空になる行。ローディング中でなければ確定候補の空行
+            if last is not None and not is_loading:
+                found_empty_after_diamond = True
+            continue
+        if cont2[0] in _spinners:
+            # ローディングメッセージ（スピナー）が来たら、まだ生成中
+            is_loading = True
             found_empty_after_diamond = False
-            spinner_chars = '⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏'
-            is_loading = False
-            
-            while time.time() < deadline:
-                try:
-                    line2 = child.readline().rstrip('\r\n')
-                except Exception:
-                    break
-                clean2 = ansi_re.sub('', line2)
-                cont2 = clean2.strip()
-                
-                # ✦で新しい回答が始まった場合は更新（ストリーミングで何度も来る）
-                m2 = re.search(r'✦\s*(.*)', cont2)
-                if m2:
-                    body2 = m2.group(1).strip()
-                    if body2:
-                        last = body2
-                        found_empty_after_diamond = False
-                    continue
-                
-                # ローディングメッセージ（スピナー）が来たら、まだ生成中
-                if any(cont2.startswith(c) for c in spinner_chars):
-                    is_loading = True
-                    found_empty_after_diamond = False
-                    continue
-                
-                # ANSI削除後に空になる行（実質的な空行）
-                if cont2 == '' and last is not None:
-                    # ローディング中でなければ空行としてカウント
-                    if not is_loading:
-                        found_empty_after_diamond = True
-                    continue
-                
-                # 空行の後にUsing:が来たら確定
-                if found_empty_after_diamond and cont2.startswith('Using:'):
-                    phase2_elapsed = time.time() - phase2_start
-                    print(f"[DEBUG Phase2] Confirmed after {phase2_elapsed:.2f}s: {last!r}")
-                    return last
-                
-                # スピナー以外の実質的な内容が来たらローディング終了
-                if cont2 != '' and not any(cont2.startswith(c) for c in spinner_chars):
-                    is_loading = False
-                
-            phase2_elapsed = time.time() - phase2_start
-            print(f"[DEBUG Phase2] Timeout after {phase2_elapsed:.2f}s, last={last!r}")
+            continue
+        # ✦を含まない行（大半）は find 1回（負なら即 None）で弾かれる
+        body2 = _parse(cont2)
+        if body2 is not None:
+            # ✦で新しい回答が始まった場合は更新（ストリーミングで何度も来る）
+            if body2:
+                last = body2
+                found_empty_after_diamond = False
+            continue
+        if found_empty_after_diamond and 'Using:' in cont2:
+            # 空行の後にUsing:が来たら確定。リテラル1個の検出なので
+            # startswith より頑健な in（C実装の文字列検索）で見る
+            # （行頭に枠線等の装飾が残っていても拾える）
+            phase2_elapsed = _monotonic() - phase2_start
+            if DEBUG:
+                print(f"[DEBUG Phase2] Confirmed after {phase2_elapsed:.2f}s: {last!r}")
             return last
+        # ここまで来たらスピナーでも✦でもない実質的な内容 → ローディング終了
+        is_loading = False
+
+    phase2_elapsed = _monotonic() - phase2_start
+    if DEBUG:
+        print(f"[DEBUG Phase2] Timeout after {phase2_elapsed:.2f}s, last={last!r}")
+    return last
+
+
+def wait_answer(
+    child,
+    timeout_s: int = 20,
+    skip_text: str | None = None,
+    _monotonic=time.monotonic,
+    _parse=parse_diamond,
+    _strip=strip_ansi,
+) -> str | None:
+    deadline = _monotonic() + timeout_s
+    if DEBUG:
+        print(f"[DEBUG wait_answer] Starting, timeout={timeout_s}s, skip_text={skip_text!r}")
 
-        # Phase 1: find a new ✦ line whose body != skip_text
+    # Phase 1: find a new ✦ line whose body != skip_text
+    if DEBUG:
         print(f"[DEBUG Phase1] Starting Phase 1")
-        phase1_start = time.time()
-        while time.time() < deadline:
-            try:
-                line = child.readline().rstrip('\r\n')
-            except Exception:
-                break
-            clean = ansi_re.sub('', line)
-            content = clean.strip()
-            # ✦ が行頭でなくても同一行に連結されるケースを拾う
-            m = re.search(r'✦\s*(.*)', content)
-            if m:
-                body = m.group(1).strip()
-                phase1_elapsed = time.time() - phase1_start
+    phase1_start = _monotonic()
+    lines = iter_lines(child, deadline)
+    for line in lines:
+        clean = _strip(line)
+        content = clean.strip()
+        # ✦ が行頭でなくても同一行に連結されるケースを拾う
+        # （✦を含まない行は find 1回で弾かれる）
+        body = _parse(content)
+        if body is not None:
+            phase1_elapsed = _monotonic() - phase1_start
+            if DEBUG:
                 print(f"[DEBUG Phase1] Found ✦ after {phase1_elapsed:.2f}s: {body!r}")
-                if body and (skip_text is None or body != skip_text):
-                    # Phase 2: after first new ✦, wait until confirmation marker
-                    # and return the last body seen.
+            if body and (skip_text is None or body != skip_text):
+                # Phase 2: after first new ✦, wait until confirmation marker
+                # and return the last body seen.
+                if DEBUG:
                     print(f"[DEBUG Phase1] Entering Phase 2 with: {body!r}")
-                    rest = read_until_confirmed_return_last(initial_text=body)
-                    return rest
-                else:
-                    # This ✦ matches skip_text → skip this block until its confirmation, then continue outer loop
+                rest = read_until_confirmed_return_last(lines, initial_text=body)
+                return rest
+            else:
+                # This ✦ matches skip_text → skip this block until its confirmation, then continue outer loop
+                if DEBUG:
                     print(f"[DEBUG Phase1] Skipping ✦ (matches skip_text), waiting for next")
-                    _ = read_until_confirmed_return_last(initial_text=body)
-                    continue
-            # ignore other content until first new ✦
-            continue
-        print(f"[DEBUG Phase1] Timeout after {time.time() - phase1_start:.2f}s")
-        return None
+                _ = read_until_confirmed_return_last(lines, initial_text=body)
+                continue
+        # ignore other content until first new ✦
+        continue
+    if DEBUG:
+        print(f"[DEBUG Phase1] Timeout after {_monotonic() - phase1_start:.2f}s")
+    return None
 
-    def send_and_time(message: str, prev_answer: str | None = None) -> tuple[str | None, float]:
-        # 前段でwait_prompt()済みを前提に、即送信・即確定
-        # 特殊文字を全角に変換してから送信
-        sanitized_message = sanitize_text(message)
+
+def send_and_time(child, message: str, prev_answer: str | None = None) -> tuple[str | None, float]:
+    # 前段でwait_prompt()済みを前提に、即送信・即確定
+    # 特殊文字を全角に変換してから送信
+    sanitized_message = sanitize_text(message)
+    if DEBUG:
         print(f"[DEBUG] Original message: {message}")
-        if sanitized_message != message:
+    if sanitized_message != message:
+        if DEBUG:
             print(f"[DEBUG] Sanitized message: {sanitized_message}")
-        child.send(sanitized_message)
-        time.sleep(0.1)
-        start = time.monotonic()
-        child.send('\r')
-        ans = wait_answer(DEFAULT_TIMEOUT, skip_text=prev_answer, quiet_s=1.0)
-        elapsed = time.monotonic() - start
-        return ans, elapsed
-    
-    def print_result(turn_name: str, answer: str | None, elapsed: float):
-        # 回答結果を出力するヘルパー関数
-        print(f"{turn_name} answer ({elapsed:.2f}s): {answer!r}")
-        if answer is not None:
-            print(f"[確定] {turn_name} captured ({elapsed:.2f}s): {answer!r}")
-    
-    def send_message_and_wait(turn_name: str, message: str, prev_answer: str | None = None) -> str | None:
-        # メッセージ送信から結果出力までの一連の処理
-        print(f"\n=== Sending {turn_name}: {message} ===")
-        answer, elapsed = send_and_time(message, prev_answer)
-        print_result(turn_name, answer, elapsed)
-        wait_prompt()
-        return answer
+    # 本文とCRを1回のwrite(2)で送る。旧実装の send → sleep(0.1) → send('\r')
+    # は、ターン毎に固定100msを計測外で浪費していた
+    start = time.monotonic()
+    child.send(sanitized_message + '\r')
+    ans = wait_answer(child, DEFAULT_TIMEOUT, skip_text=prev_answer)
+    elapsed = time.monotonic() - start
+    return ans, elapsed
+
+
+def print_result(turn_name: str, answer: str | None, elapsed: float):
+    # 回答結果を出力するヘルパー関数
+    print(f"{turn_name} answer ({elapsed:.2f}s): {answer!r}")
+    if answer is not None:
+        print(f"[確定] {turn_name} captured ({elapsed:.2f}s): {answer!r}")
+
+
+def send_message_and_wait(child, turn_name: str, message: str, prev_answer: str | None = None) -> str | None:
+    # メッセージ送信から結果出力までの一連の処理
+    print(f"\n=== Sending {turn_name}: {message} ===")
+    answer, elapsed = send_and_time(child, message, prev_answer)
+    print_result(turn_name, answer, elapsed)
+    wait_prompt(child)
+    return answer
+
+
+def main():
+    print("Starting gemini with pexpect (simple 2-turn test)...")
+
+    child = pexpect.spawn('gemini', ['-m', 'gemini-2.5-flash'], encoding='utf-8', timeout=60)
+    child.setwinsize(24, 160)
+
+    # 64KBバッファで write syscall を償却する
+    log_file = open('/tmp/gemini_pexpect.log', 'w', buffering=65536)
+    # logfile_read なら子プロセスの出力のみ記録される（自分の送信はミラーしない）
+    child.logfile_read = Tee(sys.stdout, log_file)
 
     try:
         print("Waiting for initial prompt...")
-        if not wait_prompt():
+        if not wait_prompt(child):
             print("✗ Prompt not ready")
             return
 
@@ -208,15 +313,15 @@ def main():
             'このルールを覚えて、以降の字幕に対してコメントしてください。\n'
             '了解したら「了解」とだけ答えてください。\n'
         )
-        ack = send_message_and_wait("system prompt", system_prompt)
+        ack = send_message_and_wait(child, "system prompt", system_prompt)
 
         # Test turns
-        ans1 = send_message_and_wait("1st", 'ZAGAN「よーし、始めるか」', ack)
-        ans2 = send_message_and_wait("2nd", 'ZAGAN「今日はBR4.7で行くか」', ans1)
-        ans3 = send_message_and_wait("3rd", 'ZAGAN「今日はなんの戦車使うかな?」', ans2 or ans1)
+        ans1 = send_message_and_wait(child, "1st", 'ZAGAN「よーし、始めるか」', ack)
+        ans2 = send_message_and_wait(child, "2nd", 'ZAGAN「今日はBR4.7で行くか」', ans1)
+        ans3 = send_message_and_wait(child, "3rd", 'ZAGAN「今日はなんの戦車使うかな?」', ans2 or ans1)
 
         # Quitは干渉するため本テストでは送信しない
-        # wait_prompt()
+        # wait_prompt(child)
         # child.send('/quit'); time.sleep(0.1); child.send('\r')
         # try:
         #     child.expect(pexpect.EOF, timeout=5)
@@ -229,6 +334,8 @@ def main():
     finally:
         try:
             try:
+                sys.stdout.flush()
+                log_file.flush()
                 log_file.close()
             except Exception:
                 pass
@@ -237,12 +344,16 @@ def main():
             pass
         print("\n=== Tail of log (last 400 chars) ===")
         try:
-            with open('/tmp/gemini_pexpect.log', 'r') as f:
-                content = f.read()
-                print(content[-400:])
+            # ファイル全体を読み込まず、末尾だけ seek して取り出す
+            # （UTF-8の多バイト文字を考慮して 400 文字ぶんより広めに読む）
+            with open('/tmp/gemini_pexpect.log', 'rb') as f:
+                f.seek(0, 2)
+                size = f.tell()
+                f.seek(max(0, size - 1600))
+                tail = f.read().decode('utf-8', errors='replace')
+                print(tail[-400:])
         except Exception:
             pass
 
 if __name__ == "__main__":
     main()
-